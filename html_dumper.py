@@ -8,7 +8,14 @@ from __future__ import print_function
 import sys
 import codecs
 import os
+import queue
+from collections import deque
+import re
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+from lxml import etree
 from lxml import html
 from lxml.etree import XMLSyntaxError
 
@@ -19,6 +26,29 @@ import settings
 CONFLUENCE_DUMPER_VERSION = '1.1.0'
 TITLE_OUTPUT = 'C O N F L U E N C E   D U M P E R  %s' % CONFLUENCE_DUMPER_VERSION
 
+# Console indentations per hierarchy depth
+_INDENTS = tuple('\t' * level for level in range(64))
+
+# Amount of pages which are fetched concurrently
+FETCH_WORKERS = 16
+
+# Amount of pages which may be requested ahead of the export; bounds the page bodies held in memory
+MAX_RUNNING_PAGES = 2 * FETCH_WORKERS
+
+# Links to other Confluence pages, either via space and title or via page id
+# Example: /display/TES/pictest1
+# Example: /pages/viewpage.action?pageId=524291
+PAGE_LINK_PATTERN = re.compile(r'/display/|/pages/viewpage\.action\?pageId=(.*)')
+
+# Every exported space folder gets a manifest which lists its pages, one JSON object per line
+MANIFEST_FILE_NAME = '_manifest.jsonl'
+
+# Amount of exported files which may wait for the writer thread
+WRITER_QUEUE_SIZE = 64
+
+# Anchors which link to other Confluence pages (compiled once, one tree walk per page)
+PAGE_LINK_XPATH = etree.XPath('//a[contains(@href, "/display/") or contains(@href, "/pages/viewpage.action?pageId=")]')
+
 
 def error_print(*args, **kwargs):
     """ Wrapper for the print function which leads to stderr outputs.
@@ -29,6 +59,11 @@ def error_print(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
+def _indent(level):
+    """ Provides the console indentation for a hierarchy level (precomputed for all but very deep levels). """
+    return _INDENTS[level] if level < len(_INDENTS) else '\t' * level
+
+
 def provide_unique_file_name(duplicate_file_names, file_matching, file_title, is_folder=False,
                              explicit_file_extension=None):
     """ Provides a unique AND sanitized file name for a given page title. """
@@ -61,6 +96,39 @@ def provide_unique_file_name(duplicate_file_names, file_matching, file_title, is
     return file_name
 
 
+def localize_page_link(href, page_duplicate_file_names, page_file_matching):
+    """ Maps a link to another Confluence page to the offline file of that page.
+
+    :param href: Link target.
+    :param page_duplicate_file_names: A dict in the structure {'<sanitized filename>': amount of duplicates}
+    :param page_file_matching: A dict in the structure {'<page title>': '<used offline filename>'}
+    :returns: Local link; None if the link does not refer to a Confluence page.
+    """
+    page_link = PAGE_LINK_PATTERN.search(href)
+    if page_link is None:
+        return None
+
+    # Fix links to other Confluence pages when page ids are used
+    page_id = page_link.group(1)
+    if page_id is not None:
+        offline_link = '%s.html' % utils.sanitize_for_filename(page_id)
+        return utils.encode_url(offline_link)
+
+    # Fix links to other Confluence pages
+    # Example: /display/TES/pictest1
+    #       => pictest1.html
+    try:
+        page_title = href.split('/')[4]
+    except IndexError:
+        page_title = href.split('/')[3]
+
+    page_title = page_title.replace('+', ' ')
+    decoded_page_title = utils.decode_url(page_title)
+    offline_link = provide_unique_file_name(page_duplicate_file_names, page_file_matching, decoded_page_title,
+                                            explicit_file_extension='html')
+    return utils.encode_url(offline_link)
+
+
 def handle_html_references(html_content, page_duplicate_file_names, page_file_matching, depth=0):
     """ Repairs links in the page contents with local links.
 
@@ -72,43 +140,123 @@ def handle_html_references(html_content, page_duplicate_file_names, page_file_ma
     """
     if html_content == "":
         return ""
+
+    # Skip parsing entirely if there are no links which could be rewritten
+    if '/display/' not in html_content and '/pages/viewpage.action?pageId=' not in html_content:
+        return html_content
+
     try:
         html_tree = html.fromstring(html_content)
     except XMLSyntaxError:
         print('%sWARNING: Could not parse HTML content of last page. Original content will be downloaded as it is.'
-              % ('\t'*(depth+1)))
+              % _indent(depth + 1))
         return html_content
 
-    # Fix links to other Confluence pages
-    xpath_expr = '//a[contains(@href, "/display/")]'
-    for link_element in html_tree.xpath(xpath_expr):
-        if not link_element.get('class'):
-            try:
-                page_title = link_element.attrib['href'].split('/')[4]
-            except:
-                page_title = link_element.attrib['href'].split('/')[3]
+    # Pages usually link the same targets several times; every distinct href is only resolved once
+    offline_links = {}
+    for link_element in PAGE_LINK_XPATH(html_tree):
+        if link_element.get('class'):
+            continue
 
-            page_title = page_title.replace('+', ' ')
-            decoded_page_title = utils.decode_url(page_title)
-            offline_link = provide_unique_file_name(page_duplicate_file_names, page_file_matching, decoded_page_title,
-                                                    explicit_file_extension='html')
-            link_element.attrib['href'] = utils.encode_url(offline_link)
+        href = link_element.attrib['href']
+        if href not in offline_links:
+            offline_links[href] = localize_page_link(href, page_duplicate_file_names, page_file_matching)
+        if offline_links[href] is not None:
+            link_element.attrib['href'] = offline_links[href]
 
-    # Fix links to other Confluence pages when page ids are used
-    xpath_expr = '//a[contains(@href, "/pages/viewpage.action?pageId=")]'
-    for link_element in html_tree.xpath(xpath_expr):
-        if not link_element.get('class'):
-            page_id = link_element.attrib['href'].split('/pages/viewpage.action?pageId=')[1]
-            offline_link = '%s.html' % utils.sanitize_for_filename(page_id)
-            link_element.attrib['href'] = utils.encode_url(offline_link)
+    return html.tostring(html_tree, encoding='unicode')
+
+
+def _fetch_one(page_id):
+    """ Fetches a single Confluence page and lists the ids of its child pages (runs in a worker thread).
+
+    :param page_id: Confluence page id.
+    :returns: Tuple of the page title, the page content and a list of child page ids.
+    :raises: ConfluenceException if the page or its child pages could not be requested.
+    """
+    page_url = '%s/wiki/rest/api/content/%s?expand=children.page,body.view.value' % (settings.CONFLUENCE_BASE_URL, page_id)
+    response = utils.http_get(page_url, auth=settings.HTTP_AUTHENTICATION, headers=settings.HTTP_CUSTOM_HEADERS,
+                              verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
+                              proxies=settings.HTTP_PROXIES)
+
+    # The first child pages are embedded in the page response; only list them separately if there are more
+    embedded_child_pages = response['children']['page']
+    if embedded_child_pages.get('_links', {}).get('next'):
+        child_page_ids = utils.fetch_child_page_ids(settings.CONFLUENCE_BASE_URL, page_id,
+                                                    auth=settings.HTTP_AUTHENTICATION,
+                                                    headers=settings.HTTP_CUSTOM_HEADERS,
+                                                    verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
+                                                    proxies=settings.HTTP_PROXIES)
+    else:
+        child_page_ids = [child_page['id'] for child_page in embedded_child_pages['results']]
+    return response['title'], response['body']['view']['value'], child_page_ids
 
-    return html.tostring(html_tree)
+
+def _export_page(page_id, page_title, page_content, folder_path, html_template, depth, page_duplicate_file_names,
+                 page_file_matching, writer_queue):
+    """ Exports a fetched Confluence page (runs in the crawling thread, so file names are assigned in crawl order).
+
+    :param page_id: Confluence page id.
+    :param page_title: Confluence page title.
+    :param page_content: Confluence HTML content.
+    :param folder_path: Folder to place downloaded pages in.
+    :param html_template: HTML template used to export Confluence pages.
+    :param depth: Hierarchy depth of the handled Confluence page.
+    :param page_duplicate_file_names: A dict in the structure {'<sanitized page filename>': amount of duplicates}
+    :param page_file_matching: A dict in the structure {'<page title>': '<used offline filename>'}
+    :param writer_queue: Queue of the writer thread which writes the exported files.
+    :returns: Information about the exported page as a dict.
+    """
+    print('%sPAGE: %s (%s)' % (_indent(depth + 1), page_title, page_id))
+
+    # Construct unique file name
+    file_name = provide_unique_file_name(page_duplicate_file_names, page_file_matching, page_title,
+                                         explicit_file_extension='html')
+
+    # Export HTML file
+    page_content = handle_html_references(page_content, page_duplicate_file_names, page_file_matching,
+                                          depth=depth + 1)
+    file_path = os.path.join(folder_path, file_name)
+    writer_queue.put((file_path, page_title, page_content, html_template, None))
+
+    # Save another file with page id which forwards to the original one
+    id_file_path = os.path.join(folder_path, '%s.html' % page_id)
+    id_file_page_title = 'Forward to page %s' % page_title
+    original_file_link = utils.encode_url(utils.sanitize_for_filename(file_name))
+    id_file_page_content = settings.HTML_FORWARD_MESSAGE % (original_file_link, page_title)
+    id_file_forward_header = '<meta http-equiv="refresh" content="0; url=%s" />' % original_file_link
+    writer_queue.put((id_file_path, id_file_page_title, id_file_page_content, html_template,
+                      [id_file_forward_header]))
+
+    # Remember this file for the manifest
+    return {'file_path': file_name, 'title': page_title}
+
+
+def write_html_files(writer_queue):
+    """ Writes queued HTML files until None is queued.
+
+    :param writer_queue: Queue of (path, title, content, html_template, additional_headers) tuples.
+    """
+    while True:
+        html_file = writer_queue.get()
+        if html_file is None:
+            break
+
+        file_path, title, content, html_template, additional_headers = html_file
+        try:
+            utils.write_html_2_file(file_path, title, content, html_template, additional_headers=additional_headers)
+        except Exception as e:
+            error_print('ERROR: Could not write %s: %s' % (file_path, e))
 
 
 def fetch_page_recursively(page_id, folder_path, download_folder, html_template, depth=0,
                            page_duplicate_file_names=None, page_file_matching=None):
     """ Fetches a Confluence page and its child pages (without attachments).
 
+    The page tree is traversed breadth-first; pages are requested by a pool of worker threads and exported in the
+    crawling thread. At most MAX_RUNNING_PAGES pages are requested ahead of the export, and every exported page is
+    appended to a manifest file right away, so neither the page tree nor all page bodies are kept in memory.
+
     :param page_id: Confluence page id.
     :param folder_path: Folder to place downloaded pages in.
     :param download_folder: Folder to place downloaded files in.
@@ -116,94 +264,104 @@ def fetch_page_recursively(page_id, folder_path, download_folder, html_template,
     :param depth: (optional) Hierarchy depth of the handled Confluence page.
     :param page_duplicate_file_names: A dict in the structure {'<sanitized page filename>': amount of duplicates}
     :param page_file_matching: A dict in the structure {'<page title>': '<used offline filename>'}
-    :returns: Information about downloaded pages as a dict (None for exceptions)
+    :returns: Path of the manifest of downloaded pages (None for exceptions)
     """
     if not page_duplicate_file_names:
         page_duplicate_file_names = {}
     if not page_file_matching:
         page_file_matching = {}
 
-    page_url = '%s/wiki/rest/api/content/%s?expand=children.page,body.view.value' % (settings.CONFLUENCE_BASE_URL, page_id)
-    try:
-        response = utils.http_get(page_url, auth=settings.HTTP_AUTHENTICATION, headers=settings.HTTP_CUSTOM_HEADERS,
-                                  verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
-                                  proxies=settings.HTTP_PROXIES)
-        page_content = response['body']['view']['value']
-        if isinstance(page_content, bytes):
-            page_content = page_content.decode('utf-8')
-
-        page_title = response['title']
-        print('%sPAGE: %s (%s)' % ('\t'*(depth+1), page_title, page_id))
-
-        # Construct unique file name
-        file_name = provide_unique_file_name(page_duplicate_file_names, page_file_matching, page_title,
-                                             explicit_file_extension='html')
-
-        # Remember this file and all children
-        path_collection = {'file_path': file_name, 'page_title': page_title, 'child_pages': []}
-
-        # Export HTML file
-        page_content = handle_html_references(page_content, page_duplicate_file_names, page_file_matching,
-                                              depth=depth + 1)
-        file_path = f'{folder_path}/{file_name}'
-        utils.write_html_2_file(file_path,page_title,page_content, html_template)
-        # utils.write_html_2_file(file_path, page_title, page_content, html_template, replacements={})
-
-        # Save another file with page id which forwards to the original one
-        id_file_path = '%s/%s.html' % (folder_path, page_id)
-        id_file_page_title = 'Forward to page %s' % page_title
-        original_file_link = utils.encode_url(utils.sanitize_for_filename(file_name))
-        id_file_page_content = settings.HTML_FORWARD_MESSAGE % (original_file_link, page_title)
-        id_file_forward_header = '<meta http-equiv="refresh" content="0; url=%s" />' % original_file_link
-        utils.write_html_2_file(id_file_path, id_file_page_title, id_file_page_content, html_template,
-                                additional_headers=[id_file_forward_header])
-
-        # Iterate through all child pages
-        page_url = '%s/wiki/rest/api/content/%s/child/page?limit=25' % (settings.CONFLUENCE_BASE_URL, page_id)
-        counter = 0
-        while page_url:
-            response = utils.http_get(page_url, auth=settings.HTTP_AUTHENTICATION, headers=settings.HTTP_CUSTOM_HEADERS,
-                                      verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
-                                      proxies=settings.HTTP_PROXIES)
-            counter += len(response['results'])
-            for child_page in response['results']:
-                paths = fetch_page_recursively(child_page['id'], folder_path, download_folder, html_template,
-                                               depth=depth+1, page_duplicate_file_names=page_duplicate_file_names,
-                                               page_file_matching=page_file_matching)
-                if paths:
-                    path_collection['child_pages'].append(paths)
-
-            if 'next' in response['_links'].keys():
-                page_url = response['_links']['next']
-                page_url = '%s%s' % (settings.CONFLUENCE_BASE_URL, page_url)
-            else:
-                page_url = None
-        return path_collection
-
-    except utils.ConfluenceException as e:
-        error_print('%sERROR: %s' % ('\t'*(depth+1), e))
-        return None
+    # Pending pages are tuples of page id, depth, parent page id and position among the siblings
+    pending_pages = deque([(page_id, depth, None, 0)])
 
+    # Running pages are handled in the order they were submitted (breadth-first), independent of which request
+    # finishes first; this keeps console output and file names deterministic
+    running_pages = deque()
+    queued_page_ids = {page_id}
+    root_page_fetched = False
+    manifest_path = os.path.join(folder_path, MANIFEST_FILE_NAME)
 
-def create_html_index(index_content):
+    # Exported files are written by a separate thread so that fetching does not wait for the disk
+    writer_queue = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+    writer = threading.Thread(target=write_html_files, args=(writer_queue,))
+    writer.start()
+    try:
+        with open(manifest_path, 'wb') as manifest, ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            try:
+                while running_pages or pending_pages:
+                    while pending_pages and len(running_pages) < MAX_RUNNING_PAGES:
+                        pending_page = pending_pages.popleft()
+                        running_pages.append((executor.submit(_fetch_one, pending_page[0]),) + pending_page)
+
+                    future, finished_page_id, finished_depth, parent_page_id, position = running_pages.popleft()
+                    try:
+                        page_title, page_content, children = future.result()
+                    except utils.ConfluenceException as e:
+                        error_print('%sERROR: %s' % (_indent(finished_depth + 1), e))
+                        continue
+
+                    path_entry = _export_page(finished_page_id, page_title, page_content, folder_path,
+                                              html_template, finished_depth, page_duplicate_file_names,
+                                              page_file_matching, writer_queue)
+                    root_page_fetched = root_page_fetched or finished_page_id == page_id
+                    path_entry.update(id=finished_page_id, parent=parent_page_id, position=position)
+                    manifest.write(orjson.dumps(path_entry) + b'\n')
+
+                    # Pages which are linked from several parents are only fetched (and listed) once
+                    children = [child_page_id for child_page_id in children if child_page_id not in queued_page_ids]
+                    queued_page_ids.update(children)
+                    for child_position, child_page_id in enumerate(children):
+                        pending_pages.append((child_page_id, finished_depth + 1, finished_page_id, child_position))
+            except BaseException:
+                # Do not request the remaining pages after an error or an interrupt
+                for running_page in running_pages:
+                    running_page[0].cancel()
+                raise
+    finally:
+        writer_queue.put(None)
+        writer.join()
+
+    return manifest_path if root_page_fetched else None
+
+
+def create_html_index(manifest_path):
     """ Creates an HTML index (mainly to navigate through the exported pages).
 
-    :param index_content: Dictionary which contains file paths, page titles and their children recursively.
+    The page tree is rebuilt from the manifest in a single pass and walked with an explicit stack which holds pages as
+    well as the closing tags which have to be emitted after their children; all parts are joined once at the end.
+
+    :param manifest_path: Path of the manifest written by fetch_page_recursively.
     :returns: Content index as HTML.
     """
-    file_path = utils.encode_url(index_content['file_path'])
-    page_title = index_content['page_title']
-    page_children = index_content['child_pages']
+    root_page = None
+    child_pages = {}
+    with open(manifest_path, 'rb') as manifest:
+        for line in manifest:
+            page = orjson.loads(line)
+            if page['parent'] is None:
+                root_page = page
+            else:
+                child_pages.setdefault(page['parent'], []).append(page)
 
-    html_content = '<a href="%s">%s</a>' % (utils.sanitize_for_filename(file_path), page_title)
+    html_parts = []
+    unvisited = [root_page] if root_page else []
+    while unvisited:
+        page = unvisited.pop()
+        if isinstance(page, str):
+            html_parts.append(page)
+            continue
 
-    if len(page_children) > 0:
-        html_content += '<ul>\n'
-        for child in page_children:
-            html_content += '\t<li>%s</li>\n' % create_html_index(child)
-        html_content += '</ul>\n'
+        file_path = utils.encode_url(page['file_path'])
+        html_parts.append('<a href="%s">%s</a>' % (utils.sanitize_for_filename(file_path), page['title']))
 
-    return html_content
+        page_children = sorted(child_pages.pop(page['id'], []), key=lambda child: child['position'])
+        if len(page_children) > 0:
+            html_parts.append('<ul>\n')
+            unvisited.append('</ul>\n')
+            for child in reversed(page_children):
+                unvisited.extend(('</li>\n', child, '\t<li>'))
+
+    return ''.join(html_parts)
 
 
 def print_welcome_output():
@@ -236,16 +394,25 @@ def main():
         shutil.rmtree(settings.EXPORT_FOLDER)
     os.makedirs(settings.EXPORT_FOLDER)
 
+    # Reuse one pooled HTTP session (keep-alive) for all requests
+    utils.open_http_session()
+
+    # Decide once whether child pages can be listed via the Confluence API v2
+    utils.detect_child_pages_api(settings.CONFLUENCE_BASE_URL, auth=settings.HTTP_AUTHENTICATION,
+                                 headers=settings.HTTP_CUSTOM_HEADERS,
+                                 verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
+                                 proxies=settings.HTTP_PROXIES)
+
     # Read HTML template
     template_file = open(settings.TEMPLATE_FILE)
-    html_template = template_file.read()
+    html_template = utils.compile_html_template(template_file.read())
 
     # Fetch all spaces if spaces were not configured via settings
     if len(settings.SPACES_TO_EXPORT) > 0:
         spaces_to_export = settings.SPACES_TO_EXPORT
     else:
         spaces_to_export = []
-        page_url = '%s/wiki/api/v2/spaces?limit=25' % settings.CONFLUENCE_BASE_URL
+        page_url = '%s/wiki/api/v2/spaces?limit=250' % settings.CONFLUENCE_BASE_URL
         while page_url:
             response = utils.http_get(page_url, auth=settings.HTTP_AUTHENTICATION, headers=settings.HTTP_CUSTOM_HEADERS,
                                       verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
@@ -253,7 +420,7 @@ def main():
             for space in response['results']:
                 spaces_to_export.append(space['id'])
 
-            if 'next' in response['_links'].keys():
+            if 'next' in response['_links']:
                 page_url = response['_links']['next']
                 page_url = '%s%s' % (settings.CONFLUENCE_BASE_URL, page_url)
             else:
@@ -270,11 +437,16 @@ def main():
 
         # Create folders for this space
         space_folder_name = provide_unique_file_name(duplicate_space_names, space_matching, space, is_folder=True)
-        space_folder = '%s/%s' % (settings.EXPORT_FOLDER, space_folder_name)
+        space_folder = os.path.join(settings.EXPORT_FOLDER, space_folder_name)
+        if os.path.isdir(space_folder):
+            print('WARNING: The space %s has been exported already. Maybe you mentioned it twice in the settings'
+                  % space)
+            continue
+
         try:
             os.makedirs(space_folder)
-            download_folder = '%s/%s' % (space_folder, settings.DOWNLOAD_SUB_FOLDER)
-            os.makedirs(download_folder)
+            download_folder = os.path.join(space_folder, settings.DOWNLOAD_SUB_FOLDER)
+            os.makedirs(download_folder, exist_ok=True)
 
             print("Exporting this page %s" % space)
             space_url = '%s/wiki/api/v2/spaces/%s?expand=homepage' % (settings.CONFLUENCE_BASE_URL, space)
@@ -288,19 +460,18 @@ def main():
 
             space_page_id = response['homepageId']
 
-            path_collection = fetch_page_recursively(space_page_id, space_folder, download_folder, html_template)
+            manifest_path = fetch_page_recursively(space_page_id, space_folder, download_folder, html_template)
 
-            if path_collection:
+            if manifest_path:
                 # Create index file for this space
-                space_index_path = '%s/index.html' % space_folder
+                space_index_path = os.path.join(space_folder, 'index.html')
                 space_index_title = 'Index of Space %s (%s)' % (space_name, space)
-                space_index_content = create_html_index(path_collection)
+                space_index_content = create_html_index(manifest_path)
                 utils.write_html_2_file(space_index_path, space_index_title, space_index_content, html_template)
         except utils.ConfluenceException as e:
             error_print('ERROR: %s' % e)
-        except OSError:
-            print('WARNING: The space %s has been exported already. Maybe you mentioned it twice in the settings'
-                  % space)
+        except OSError as e:
+            error_print('ERROR: %s' % e)
 
     # Finished output
     print_finished_output()
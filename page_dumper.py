@@ -8,6 +8,8 @@ from __future__ import print_function
 import sys
 import codecs
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import utils
 import settings
 
@@ -15,53 +17,107 @@ import settings
 CONFLUENCE_DUMPER_VERSION = '1.1.0'
 TITLE_OUTPUT = 'C O N F L U E N C E   D U M P E R  %s' % CONFLUENCE_DUMPER_VERSION
 
+# Console indentations per hierarchy depth
+_INDENTS = tuple('\t' * level for level in range(64))
+
+# Amount of pages which are fetched concurrently
+FETCH_WORKERS = 16
+
+# Amount of pages which may be requested ahead of the crawling thread
+MAX_RUNNING_PAGES = 2 * FETCH_WORKERS
+
 
 def error_print(*args, **kwargs):
     """ Wrapper for the print function which leads to stderr outputs. """
     print(*args, file=sys.stderr, **kwargs)
 
 
-def fetch_page_ids_recursively(page_id, depth=0):
-    """ Fetches Confluence page and its child pages, returning only page IDs.
+def _indent(level):
+    """ Provides the console indentation for a hierarchy level (precomputed for all but very deep levels). """
+    return _INDENTS[level] if level < len(_INDENTS) else '\t' * level
+
+
+def _fetch_one(page_id):
+    """ Fetches a single Confluence page and lists the ids of its child pages (runs in a worker thread).
 
     :param page_id: Confluence page id.
-    :param depth: (optional) Hierarchy depth of the handled Confluence page.
-    :returns: A list of page IDs.
+    :returns: Tuple of the page title and a list of child page IDs.
+    :raises: ConfluenceException if the page or its child pages could not be requested.
     """
-    try:
-        page_url = '%s/wiki/rest/api/content/%s?expand=children.page' % (settings.CONFLUENCE_BASE_URL, page_id)
-        response = utils.http_get(page_url, auth=settings.HTTP_AUTHENTICATION, headers=settings.HTTP_CUSTOM_HEADERS,
-                                  verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
-                                  proxies=settings.HTTP_PROXIES)
+    page_url = '%s/wiki/rest/api/content/%s?expand=children.page' % (settings.CONFLUENCE_BASE_URL, page_id)
+    response = utils.http_get(page_url, auth=settings.HTTP_AUTHENTICATION, headers=settings.HTTP_CUSTOM_HEADERS,
+                              verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
+                              proxies=settings.HTTP_PROXIES)
+
+    # The first child pages are embedded in the page response; only list them separately if there are more
+    embedded_child_pages = response['children']['page']
+    if embedded_child_pages.get('_links', {}).get('next'):
+        child_page_ids = utils.fetch_child_page_ids(settings.CONFLUENCE_BASE_URL, page_id,
+                                                    auth=settings.HTTP_AUTHENTICATION,
+                                                    headers=settings.HTTP_CUSTOM_HEADERS,
+                                                    verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
+                                                    proxies=settings.HTTP_PROXIES)
+    else:
+        child_page_ids = [child_page['id'] for child_page in embedded_child_pages['results']]
 
-        page_title = response['title']
-        print('%sPAGE: %s (%s)' % ('\t'*(depth+1), page_title, page_id))
+    return response['title'], child_page_ids
 
-        # Collect this page ID
-        page_ids = [page_id]
 
-        # Iterate through all child pages
-        child_page_url = '%s/wiki/rest/api/content/%s/child/page?limit=25' % (settings.CONFLUENCE_BASE_URL, page_id)
-        while child_page_url:
-            response = utils.http_get(child_page_url, auth=settings.HTTP_AUTHENTICATION, 
-                                      headers=settings.HTTP_CUSTOM_HEADERS, verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
-                                      proxies=settings.HTTP_PROXIES)
-            for child_page in response['results']:
-                child_page_ids = fetch_page_ids_recursively(child_page['id'], depth=depth+1)
-                page_ids.extend(child_page_ids)
-
-            # Get the next set of child pages, if available
-            if 'next' in response['_links'].keys():
-                child_page_url = response['_links']['next']
-                child_page_url = '%s%s' % (settings.CONFLUENCE_BASE_URL, child_page_url)
-            else:
-                child_page_url = None
+def fetch_page_ids_recursively(page_id, depth=0):
+    """ Fetches Confluence page and its child pages, returning only page IDs.
 
-        return page_ids
+    The page tree is traversed breadth-first by a pool of worker threads; the IDs are returned in tree order.
 
-    except utils.ConfluenceException as e:
-        error_print('%sERROR: %s' % ('\t'*(depth+1), e))
-        return []
+    :param page_id: Confluence page id.
+    :param depth: (optional) Hierarchy depth of the handled Confluence page.
+    :returns: A list of page IDs.
+    """
+    # Pending pages are tuples of page id and depth
+    pending_pages = deque([(page_id, depth)])
+
+    # Running pages are handled in the order they were submitted (breadth-first), independent of which request
+    # finishes first; this keeps the console output deterministic
+    running_pages = deque()
+    queued_page_ids = {page_id}
+    child_page_ids = {}
+
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        try:
+            while running_pages or pending_pages:
+                while pending_pages and len(running_pages) < MAX_RUNNING_PAGES:
+                    pending_page = pending_pages.popleft()
+                    running_pages.append((executor.submit(_fetch_one, pending_page[0]),) + pending_page)
+
+                future, finished_page_id, finished_depth = running_pages.popleft()
+                try:
+                    page_title, children = future.result()
+                except utils.ConfluenceException as e:
+                    error_print('%sERROR: %s' % (_indent(finished_depth + 1), e))
+                    continue
+                print('%sPAGE: %s (%s)' % (_indent(finished_depth + 1), page_title, finished_page_id))
+
+                # Pages which are linked from several parents are only fetched (and listed) once
+                children = [child_page_id for child_page_id in children if child_page_id not in queued_page_ids]
+                queued_page_ids.update(children)
+                child_page_ids[finished_page_id] = children
+                for child_page_id in children:
+                    pending_pages.append((child_page_id, finished_depth + 1))
+        except BaseException:
+            # Do not request the remaining pages after an error or an interrupt
+            for running_page in running_pages:
+                running_page[0].cancel()
+            raise
+
+    # Walk the fetched tree in pre-order, skipping pages which could not be fetched
+    page_ids = []
+    unvisited = [page_id] if page_id in child_page_ids else []
+    while unvisited:
+        current_page_id = unvisited.pop()
+        page_ids.append(current_page_id)
+        unvisited.extend(child_page_id for child_page_id in reversed(child_page_ids[current_page_id])
+                         if child_page_id in child_page_ids)
+
+    return page_ids
 
 
 def main():
@@ -71,12 +127,21 @@ def main():
     print('\t %s\n' % ('='*len(TITLE_OUTPUT)))
     print('Fetching only page IDs from Confluence...\n')
 
+    # Reuse one pooled HTTP session (keep-alive) for all requests
+    utils.open_http_session()
+
+    # Decide once whether child pages can be listed via the Confluence API v2
+    utils.detect_child_pages_api(settings.CONFLUENCE_BASE_URL, auth=settings.HTTP_AUTHENTICATION,
+                                 headers=settings.HTTP_CUSTOM_HEADERS,
+                                 verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
+                                 proxies=settings.HTTP_PROXIES)
+
     # Fetch all spaces if spaces were not configured via settings
     if len(settings.SPACES_TO_EXPORT) > 0:
         spaces_to_export = settings.SPACES_TO_EXPORT
     else:
         spaces_to_export = []
-        page_url = '%s/wiki/api/v2/spaces?limit=25' % settings.CONFLUENCE_BASE_URL
+        page_url = '%s/wiki/api/v2/spaces?limit=250' % settings.CONFLUENCE_BASE_URL
         while page_url:
             response = utils.http_get(page_url, auth=settings.HTTP_AUTHENTICATION, headers=settings.HTTP_CUSTOM_HEADERS,
                                       verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
@@ -84,7 +149,7 @@ def main():
             for space in response['results']:
                 spaces_to_export.append(space['id'])
 
-            if 'next' in response['_links'].keys():
+            if 'next' in response['_links']:
                 page_url = response['_links']['next']
                 page_url = '%s%s' % (settings.CONFLUENCE_BASE_URL, page_url)
             else:
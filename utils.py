@@ -10,7 +10,11 @@
 # This work is licensed under the terms of the MIT license.
 # See the LICENSE.md file in the top-level directory.
 
+import functools
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import shutil
 import re
 import urllib
@@ -19,8 +23,39 @@ from urllib.parse import quote, unquote
 
 class ConfluenceException(Exception):
     """ Exception for Confluence export issues """
-    def __init__(self, message):
+    def __init__(self, message, status_code=None):
         super(ConfluenceException, self).__init__(message)
+        self.status_code = status_code
+
+
+# Placeholders of HTML templates, e.g. {% title %}
+HTML_TEMPLATE_PLACEHOLDER = re.compile(r'{%\s*(title|content|additional_headers)\s*%\}', re.IGNORECASE)
+
+# Child pages are listed via the Confluence API v2; instances lacking it use the v1 API (see detect_child_pages_api)
+PAGES_URL_V2 = '%s/wiki/api/v2/pages?limit=1'
+CHILD_PAGES_URL_V2 = '%s/wiki/api/v2/pages/%s/children?limit=250'
+CHILD_PAGES_URL_V1 = '%s/wiki/rest/api/content/%s/child/page?limit=250'
+_child_pages_api_v2 = True
+
+# Shared HTTP session (see open_http_session); None means that every request opens its own connection
+_http_session = None
+
+
+def open_http_session(pool_size=32):
+    """ Opens a pooled HTTP session which keeps connections alive and is reused by all subsequent requests.
+
+    :param pool_size: (optional) Maximum amount of connections kept alive per host.
+    :returns: The shared session.
+    """
+    global _http_session
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Connection'] = 'keep-alive'
+    _http_session = session
+    return session
 
 
 def http_get(request_url, auth=None, headers=None, verify_peer_certificate=True, proxies=None):
@@ -34,12 +69,66 @@ def http_get(request_url, auth=None, headers=None, verify_peer_certificate=True,
     :returns: JSON response.
     :raises: ConfluenceException in the case of the server does not answer HTTP code 200.
     """
-    response = requests.get(request_url, auth=auth, headers=headers, verify=verify_peer_certificate, proxies=proxies)
+    requester = _http_session or requests
+    response = requester.get(request_url, auth=auth, headers=headers, verify=verify_peer_certificate, proxies=proxies)
     if 200 == response.status_code:
-        return response.json()
+        return orjson.loads(response.content)
     else:
         raise ConfluenceException('Error %s: %s on requesting %s' % (response.status_code, response.reason,
-                                                                     request_url))
+                                                                     request_url), status_code=response.status_code)
+
+
+def detect_child_pages_api(base_url, auth=None, headers=None, verify_peer_certificate=True, proxies=None):
+    """ Probes once whether child pages can be listed via the Confluence API v2; otherwise the v1 API is used.
+    Only a missing endpoint (HTTP 404 or 501) switches to the v1 API; other errors, including connection errors, are
+    left to the actual requests.
+
+    :param base_url: Confluence base URL.
+    :param auth: (optional) Auth tuple to use HTTP Auth (supported: Basic/Digest/Custom).
+    :param headers: (optional) Dictionary of HTTP Headers to send with the :class:`Request`.
+    :param verify_peer_certificate: (optional) Flag to decide whether peer certificate has to be validated.
+    :param proxies: (optional) Dictionary mapping protocol to the URL of the proxy.
+    :returns: True if the Confluence API v2 is used.
+    """
+    global _child_pages_api_v2
+    try:
+        http_get(PAGES_URL_V2 % base_url, auth=auth, headers=headers, verify_peer_certificate=verify_peer_certificate,
+                 proxies=proxies)
+        _child_pages_api_v2 = True
+    except ConfluenceException as e:
+        _child_pages_api_v2 = e.status_code not in (404, 501)
+    except requests.RequestException:
+        # The server could not be reached; the actual requests report this per space
+        _child_pages_api_v2 = True
+    return _child_pages_api_v2
+
+
+def fetch_child_page_ids(base_url, page_id, auth=None, headers=None, verify_peer_certificate=True, proxies=None):
+    """ Lists the ids of all child pages of a Confluence page (API version as detected by detect_child_pages_api).
+
+    :param base_url: Confluence base URL.
+    :param page_id: Confluence page id.
+    :param auth: (optional) Auth tuple to use HTTP Auth (supported: Basic/Digest/Custom).
+    :param headers: (optional) Dictionary of HTTP Headers to send with the :class:`Request`.
+    :param verify_peer_certificate: (optional) Flag to decide whether peer certificate has to be validated.
+    :param proxies: (optional) Dictionary mapping protocol to the URL of the proxy.
+    :returns: A list of child page IDs.
+    :raises: ConfluenceException if the child pages could not be requested.
+    """
+    child_pages_url = CHILD_PAGES_URL_V2 if _child_pages_api_v2 else CHILD_PAGES_URL_V1
+    page_url = child_pages_url % (base_url, page_id)
+
+    ids = []
+    while page_url:
+        response = http_get(page_url, auth=auth, headers=headers, verify_peer_certificate=verify_peer_certificate,
+                            proxies=proxies)
+        ids.extend(result['id'] for result in response['results'])
+
+        if 'next' in response['_links']:
+            page_url = '%s%s' % (base_url, response['_links']['next'])
+        else:
+            page_url = None
+    return ids
 
 
 def http_download_binary_file(request_url, file_path, auth=None, headers=None, verify_peer_certificate=True,
@@ -54,8 +143,9 @@ def http_download_binary_file(request_url, file_path, auth=None, headers=None, v
     :param proxies: (optional) Dictionary mapping protocol to the URL of the proxy.
     :raises: ConfluenceException in the case of the server does not answer with HTTP code 200.
     """
-    response = requests.get(request_url, stream=True, auth=auth, headers=headers, verify=verify_peer_certificate,
-                            proxies=proxies)
+    requester = _http_session or requests
+    response = requester.get(request_url, stream=True, auth=auth, headers=headers, verify=verify_peer_certificate,
+                             proxies=proxies)
     if 200 == response.status_code:
         with open(file_path, 'wb') as downloaded_file:
             response.raw.decode_content = True
@@ -65,7 +155,7 @@ def http_download_binary_file(request_url, file_path, auth=None, headers=None, v
                 downloaded_file.write("could not copy file")
     else:
         raise ConfluenceException('Error %s: %s on requesting %s' % (response.status_code, response.reason,
-                                                                     request_url))
+                                                                     request_url), status_code=response.status_code)
 
 
 def write_2_file(path, content):
@@ -81,13 +171,26 @@ def write_2_file(path, content):
     except Exception as e:
         print(f"File could not be written: {e}")
 
+def compile_html_template(html_template):
+    """ Splits an HTML template once at its placeholders, so pages can be written without any substitution pass.
+
+    :param html_template: page template; supported placeholders: ``{% title %}``, ``{% content %}``,
+                          ``{% additional_headers %}``
+    :returns: Tuple which alternates between literal template parts (UTF-8 encoded) and placeholder names.
+    """
+    template_parts = HTML_TEMPLATE_PLACEHOLDER.split(html_template)
+    return tuple(template_part.lower() if index % 2 else template_part.encode('utf-8')
+                 for index, template_part in enumerate(template_parts))
+
+
 def write_html_2_file(path, title, content, html_template, additional_headers=None):
     """ Writes HTML content to a file using a template.
 
     :param path: Local file path
     :param title: page title
     :param content: page content
-    :param html_template: page template; supported placeholders: ``{% title %}``, ``{% content %}``
+    :param html_template: page template; supported placeholders: ``{% title %}``, ``{% content %}``;
+                          either as string or as compiled by :func:`compile_html_template`
     :param additional_headers: (optional) Additional HTML headers.
     """
     html_content = html_template
@@ -95,6 +198,17 @@ def write_html_2_file(path, title, content, html_template, additional_headers=No
     # Build additional HTML headers
     additional_html_headers = '\n\t'.join(additional_headers) if additional_headers else ''
 
+    # Compiled templates are written part by part
+    if isinstance(html_template, tuple):
+        replacements = {'title': title, 'content': content, 'additional_headers': additional_html_headers}
+        try:
+            with open(path, 'wb') as the_file:
+                for index, template_part in enumerate(html_template):
+                    the_file.write(replacements[template_part].encode('utf-8') if index % 2 else template_part)
+        except Exception as e:
+            print(f"File could not be written: {e}")
+        return
+
     # Replace placeholders
     # Note: One backslash has to be escaped with two to avoid that backslashes are interpreted as escape chars
     replacements = {'title': title, 'content': content, 'additional_headers': additional_html_headers}
@@ -110,6 +224,7 @@ def write_html_2_file(path, title, content, html_template, additional_headers=No
 
     write_2_file(path, html_content)
 
+@functools.lru_cache(maxsize=8192)
 def sanitize_for_filename(original_string):
     """ Sanitizes a string to use it as a filename on most filesystems.
 
@@ -129,6 +244,7 @@ def decode_url(encoded_url):
     return unquote(encoded_url)
 
 
+@functools.lru_cache(maxsize=8192)
 def encode_url(decoded_url):
     """ Quotes and encodes a given URL.
 